@@ -1,20 +1,75 @@
 import argparse
 import glob
+import json
 import logging
 import os
+import pickle
+import shutil
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
 from datetime import datetime, timedelta
 
 import awswrangler as wrangler
 import boto3
+import botocore.config
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.dataset as pads
+import pyarrow.fs as pafs
+import pyarrow.parquet as papq
+import requests
 import yaml
 
+try:
+    # LibYAML parses 10-20x faster than the pure-Python loader when the bindings are available.
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
 AWS_BUCKET = os.environ['AWS_BUCKET']
 AWS_BUCKET_DIR = os.environ.get('AWS_BUCKET_DIR', 'nasdaq')
-AWS_COMPRESSION_TYPE = 'gzip'
+AWS_COMPRESSION_TYPE = 'zstd'
+AWS_COMPRESSION_LEVEL = 1
+AWS_MAX_ROWS_BY_FILE = 1_000_000
 DATE_STRING_FORMAT = '%Y-%m-%d'
-SPEC_FILES_PATH = '/schemas/*'
+EXPORT_POLL_INTERVAL_SECONDS = 30
+EXTRACT_SPILL_THRESHOLD_BYTES = int(os.environ.get('EXTRACT_SPILL_THRESHOLD_BYTES', 2 << 30))
+HTTP_TIMEOUT_SECONDS = 60
+MANIFEST_FILE_NAME = '_manifest.json'
+MAX_REFRESH_WORKERS = 8
+PARQUET_WRITER = os.environ.get('PARQUET_WRITER', 'pyarrow')
+SPEC_FILES_PATH = '/schemas/*.yaml'
+
+# Size the connection pool for the thread pool above and back off client-side when S3 returns SlowDown.
+S3_CLIENT_CONFIG = botocore.config.Config(max_pool_connections=64,
+                                          retries={'mode': 'adaptive', 'max_attempts': 10},
+                                          tcp_keepalive=True)
+boto3_session = boto3.Session()
+s3_client = boto3_session.client('s3', config=S3_CLIENT_CONFIG)
+s3_fs = pafs.S3FileSystem()
+wrangler.config.botocore_config = S3_CLIENT_CONFIG
+
+# Back off on 429s and 5xx like the ndl client's own session does.
+http_session = requests.Session()
+http_session.mount('https://', requests.adapters.HTTPAdapter(
+    max_retries=requests.adapters.Retry(total=5, backoff_factor=0.5,
+                                        status_forcelist=[429, 500, 502, 503, 504])))
+
+ARROW_SCHEMA_TYPES = {'str': pa.string(), 'float': pa.float64(), 'int': pa.int64(),
+                      'datetime64[ns]': pa.timestamp('ns')}
+
+
+def _arrow_type(dtype: str) -> pa.DataType:
+    """
+    Map a YAML schema dtype string to its Arrow equivalent.
+    :returns: a pyarrow DataType
+    """
+    return ARROW_SCHEMA_TYPES.get(dtype) or pa.from_numpy_dtype(dtype)
 
 
 @dataclass
@@ -23,77 +78,178 @@ class Table:
     update_field: str
     partition_cols: list[str]
     schema: dict[str: str]
+    existing_tables: set[str] = None
 
-    def __post_init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-
-        self._s3_key = (f"{AWS_BUCKET_DIR}/{self.name}"
-                        f"{'/' + self.name.split('/')[1] + '.parquet' if not self.update_field else ''}")
+    def __post_init__(self):
+        self.s3_key = (f"{AWS_BUCKET_DIR}/{self.name}"
+                       f"{'/' + self.name.split('/')[1] + '.parquet' if not self.update_field else ''}")
 
         # If there's an update key, check that there's an existing parquet directory to append to.
         if self.update_field:
-            logger.debug(f'Found update field `{self.update_field}` for {self.name}; checking for S3 object...')
+            logger.debug('Found update field `%s` for %s; checking for S3 object...', self.update_field, self.name)
             try:
-                response = s3_client.list_objects(Bucket=AWS_BUCKET, Prefix=self.s3_key, MaxKeys=1)
-                if 'Contents' in response:
-                    logger.debug(f'S3 resource check passed for {self.name}; using `append` mode.')
-                    self._refresh_mode = 'overwrite_partitions'
+                if self.existing_tables is not None:
+                    exists = self.name.split('/')[1] in self.existing_tables
                 else:
-                    logger.debug(f'S3 resource check failed for {self.name}; re-creating table.')
-                    self._refresh_mode = 'overwrite'
+                    response = s3_client.list_objects_v2(Bucket=AWS_BUCKET, Prefix=self.s3_key, MaxKeys=1)
+                    exists = response['KeyCount'] > 0
+                if exists:
+                    logger.debug('S3 resource check passed for %s; using `append` mode.', self.name)
+                    self.refresh_mode = 'overwrite_partitions'
+                else:
+                    logger.debug('S3 resource check failed for %s; re-creating table.', self.name)
+                    self.refresh_mode = 'overwrite'
             except Exception as e:
                 raise e
         else:
-            logger.debug(f'No update field provided for {self.name}; using `overwrite` mode.')
-            self._refresh_mode = 'overwrite'
+            logger.debug('No update field provided for %s; using `overwrite` mode.', self.name)
+            self.refresh_mode = 'overwrite'
 
     def _get_ndl_data(self, _date: str) -> None:
         if self.refresh_mode in ['append', 'overwrite_partitions']:
             # Get only update_key=date rows.
-            logger.info(f'Downloading new rows for: {self.name} ...')
+            logger.info('Downloading new rows for: %s ...', self.name)
             try:
                 self._data = ndl.get_table(f"{self.name}", paginate=True, **{self.update_field: _date})
             except Exception as e:
-                logger.error(f'Failed to get new rows for {self.name}: {e}')
+                logger.error('Failed to get new rows for %s: %s', self.name, e)
                 raise e
         else:
-            # Download the zip extract.
-            file_name = f"{self.name.replace('/', '.')}.zip"
-            logger.info(f'Downloading table extract: {self.name} ...')
+            # Stream the zip body into a spooled buffer: it stays in memory up to the spill threshold and
+            # rolls over to an anonymous temp file beyond it, with no cleanup to manage. The zip central
+            # directory sits at EOF, so member decompression can only begin once the download completes;
+            # from there zipfile streams the member into the parser block by block.
+            logger.info('Downloading table extract: %s ...', self.name)
             try:
-                ndl.export_table(f"{self.name}", filename=file_name)
-                self._data = pd.read_csv(file_name)
+                response = http_session.get(self._get_extract_link(), stream=True,
+                                            timeout=HTTP_TIMEOUT_SECONDS)
+                response.raise_for_status()
+                with tempfile.SpooledTemporaryFile(max_size=EXTRACT_SPILL_THRESHOLD_BYTES) as extract:
+                    shutil.copyfileobj(response.raw, extract)
+                    self._read_extract_zip(extract)
             except Exception as e:
-                logger.error(f'Failed to get new data for {self.name}: {e}')
+                logger.error('Failed to get new data for %s: %s', self.name, e)
                 raise e
-            finally:
-                if os.path.exists(file_name):
-                    os.remove(file_name)
-        logger.info(f'Fetched {len(self._data)} rows: {self.name}.')
+        logger.info('Fetched %d rows: %s.', len(self._data), self.name)
+
+    def _read_extract_zip(self, extract) -> None:
+        """
+        Parse the CSV inside a zip extract with pyarrow's parallel reader.
+        :extract: a file path or seekable file object holding the zip
+        """
+        with zipfile.ZipFile(extract) as archive:
+            with archive.open(archive.namelist()[0]) as member:
+                table = pacsv.read_csv(member, read_options=pacsv.ReadOptions(block_size=64 << 20))
+        self._data = table.to_pandas(types_mapper=pd.ArrowDtype)
+
+    def _get_extract_link(self) -> str:
+        """
+        Poll the Nasdaq Data Link bulk export endpoint until the zip extract is ready.
+        :returns: the download link for the zip extract
+        """
+        url = f'{ndl.ApiConfig.api_base}/datatables/{self.name}.json'
+        params = {'qopts.export': 'true', 'api_key': ndl.ApiConfig.api_key}
+        while True:
+            response = http_session.get(url, params=params, timeout=HTTP_TIMEOUT_SECONDS)
+            response.raise_for_status()
+            file_info = response.json()['datatable_bulk_download']['file']
+            if file_info['status'] == 'fresh':
+                return file_info['link']
+            logger.debug('Extract not ready for %s; retrying in %ds...', self.name, EXPORT_POLL_INTERVAL_SECONDS)
+            time.sleep(EXPORT_POLL_INTERVAL_SECONDS)
 
     def _apply_transforms(self) -> None:
+        # Cast in Arrow rather than pandas: one materialization, native string arrays, and vectorized
+        # year/month/day kernels for the partition expansion.
+        table = pa.Table.from_pandas(self._data, preserve_index=False)
+        dt_partition = next((column for column in self.partition_cols or []
+                             if self.schema.get(column) == 'datetime64[ns]'), None)
+        columns, names = [], []
         for column, dtype in self.schema.items():
-            if self.partition_cols:
-                if column in self.partition_cols and dtype == 'datetime64[ns]':
-                    self._data[column] = self._data[column].astype(dtype)
-                    self._data['yyyy'] = self._data[column].apply(lambda x: x.year)
-                    self._data['mm'] = self._data[column].apply(lambda x: x.month)
-                    self._data['dd'] = self._data[column].apply(lambda x: x.day)
-                    self._data.drop(column, axis=1, inplace=True)
-                    self.partition_cols.remove(column)
-                    self.partition_cols = ['yyyy', 'mm', 'dd']
+            logger.debug('Cast: %s to %s', column, dtype)
+            values = table.column(column).cast(_arrow_type(dtype))
+            if column == dt_partition:
+                for name, component, width in (('yyyy', pc.year, pa.int16()),
+                                               ('mm', pc.month, pa.int8()),
+                                               ('dd', pc.day, pa.int8())):
+                    columns.append(component(values).cast(width))
+                    names.append(name)
             elif dtype == 'datetime64[ns]':
-                self._data[column] = self._data[column].astype(dtype).dt.strftime('%Y-%m-%d')
+                # Date-only columns: date32 lets Parquet store a DATE instead of one string object per row.
+                columns.append(values.cast(pa.date32(), safe=False))
+                names.append(column)
             else:
-                logger.debug(f'Cast: {column} to {dtype}')
-                self._data[column] = self._data[column].astype(dtype)
+                columns.append(values)
+                names.append(column)
+        # Carry through any columns the schema doesn't cover.
+        for column in table.column_names:
+            if column not in self.schema:
+                columns.append(table.column(column))
+                names.append(column)
+        if dt_partition:
+            self.partition_cols = ['yyyy', 'mm', 'dd']
+        self._data = pa.table(columns, names=names).to_pandas(types_mapper=pd.ArrowDtype)
 
-    def _put_to_aws(self) -> None:
+    def _load_manifest(self) -> dict:
+        try:
+            response = s3_client.get_object(Bucket=AWS_BUCKET, Key=f'{self.s3_key}/{MANIFEST_FILE_NAME}')
+            return json.loads(response['Body'].read())
+        except s3_client.exceptions.NoSuchKey:
+            return {}
+
+    def _write_manifest(self, manifest: dict) -> None:
+        s3_client.put_object(Bucket=AWS_BUCKET, Key=f'{self.s3_key}/{MANIFEST_FILE_NAME}',
+                             Body=json.dumps(manifest).encode())
+
+    def _drop_unchanged_partitions(self) -> dict:
+        """
+        Drop partitions whose content hash matches the previous run's manifest, so overwrite_partitions only
+        re-encodes and uploads partitions that actually changed.
+        :returns: the updated manifest, to be written back after a successful upload
+        """
+        manifest = self._load_manifest()
+        changed_groups = []
+        for key, group in self._data.groupby(self.partition_cols, sort=False):
+            partition = '/'.join(f'{column}={value}' for column, value in zip(self.partition_cols, key))
+            group_hash = str(int(pd.util.hash_pandas_object(group, index=False).sum()))
+            if group_hash != manifest.get(partition):
+                changed_groups.append(group)
+                manifest[partition] = group_hash
+        skipped = len(self._data) - sum(len(group) for group in changed_groups)
+        if skipped:
+            logger.info('Skipping %d rows in unchanged partitions: %s.', skipped, self.name)
+        self._data = pd.concat(changed_groups) if changed_groups else self._data.iloc[0:0]
+        return manifest
+
+    def _put_with_pyarrow(self) -> None:
+        # write_dataset encodes and uploads row groups from multiple threads with no per-file Python
+        # orchestration in between.
+        table = pa.Table.from_pandas(self._data, preserve_index=False)
+        if self.update_field:
+            pads.write_dataset(table,
+                               base_dir=f'{AWS_BUCKET}/{self.s3_key}',
+                               filesystem=s3_fs,
+                               format='parquet',
+                               file_options=pads.ParquetFileFormat().make_write_options(
+                                   compression=AWS_COMPRESSION_TYPE,
+                                   compression_level=AWS_COMPRESSION_LEVEL),
+                               partitioning=pads.partitioning(table.select(self.partition_cols).schema,
+                                                              flavor='hive'),
+                               basename_template='part-{i}.parquet',
+                               existing_data_behavior='delete_matching',
+                               max_rows_per_file=AWS_MAX_ROWS_BY_FILE,
+                               max_rows_per_group=AWS_MAX_ROWS_BY_FILE)
+        else:
+            papq.write_table(table, f'{AWS_BUCKET}/{self.s3_key}', filesystem=s3_fs,
+                             compression=AWS_COMPRESSION_TYPE, compression_level=AWS_COMPRESSION_LEVEL)
+
+    def _put_with_wrangler(self) -> None:
         kwargs = {
             'df': self._data,
             'path': f"s3://{AWS_BUCKET}/{self.s3_key}",
             'index': False,
             'compression': AWS_COMPRESSION_TYPE,
+            'boto3_session': boto3_session,
         }
         if self.update_field:
             # Use the dataset option and 'append' mode for time series data.
@@ -101,40 +257,43 @@ class Table:
                 'dataset': True,
                 'mode': self.refresh_mode,
                 'partition_cols': self.partition_cols,
-                'concurrent_partitioning': True
+                'concurrent_partitioning': True,
+                'max_rows_by_file': AWS_MAX_ROWS_BY_FILE
             })
-        logger.info(f'Uploading {self.name}...')
+        wrangler.s3.to_parquet(**kwargs)
+
+    def _put_to_aws(self) -> None:
+        logger.info('Uploading %s...', self.name)
         try:
-            wrangler.s3.to_parquet(**kwargs)
-            logger.info(f'Finished updating {self.name}.')
+            if PARQUET_WRITER == 'awswrangler':
+                self._put_with_wrangler()
+            else:
+                self._put_with_pyarrow()
+            logger.info('Finished updating %s.', self.name)
         except Exception as e:
-            logger.error(f'Upload failed for {self.name}; {e}')
+            logger.error('Upload failed for %s; %s', self.name, e)
             raise e
 
-    @property
-    def s3_key(self) -> str:
-        """
-        The path this object will write to in its target S3 bucket.
-        :returns: a directory path
-        """
-        return self._s3_key
-
-    @property
-    def refresh_mode(self) -> str:
-        """
-        The mode setting that will be used by the awswrangler `to_parquet` method.
-        :returns: `append` or `overwrite`
-        """
-        return self._refresh_mode
-
     def refresh(self, date: str) -> None:
         """
         Update this table in AWS S3 with new data from Nasdaq Data Link.
         :date: a YYYY-MM-DD string representing the date to update.
         """
         self._get_ndl_data(_date=date)
+        if self._data.empty:
+            # Common on weekends and holidays; skip the transforms and the empty-file upload.
+            logger.info('No new rows for %s; nothing to upload.', self.name)
+            return
         self._apply_transforms()
+        manifest = None
+        if self.refresh_mode == 'overwrite_partitions':
+            manifest = self._drop_unchanged_partitions()
+            if self._data.empty:
+                logger.info('No changed partitions for %s; skipping upload.', self.name)
+                return
         self._put_to_aws()
+        if manifest is not None:
+            self._write_manifest(manifest)
 
 
 class Dataset(dict):
@@ -147,11 +306,29 @@ class Dataset(dict):
         super().__init__()
         global logger
         assert logger, 'Missing logger object; please assign.'
-        with open(file_path, 'r') as specification:
-            self.update(yaml.safe_load(specification))
-        logger.info(f'Loaded {len(self)} tables: {', '.join(self.keys())}.')
+        # Reuse the parsed spec from a pickle sidecar unless the YAML has changed since it was written.
+        cache_path = f'{file_path}.pkl'
+        if os.path.exists(cache_path) and os.stat(cache_path).st_mtime >= os.stat(file_path).st_mtime:
+            with open(cache_path, 'rb') as cache:
+                self.update(pickle.load(cache))
+        else:
+            with open(file_path, 'r') as specification:
+                self.update(yaml.load(specification, Loader=YamlLoader))
+            try:
+                with open(cache_path, 'wb') as cache:
+                    pickle.dump(dict(self), cache)
+            except OSError:
+                logger.debug('Could not write spec cache: %s.', cache_path)
+        logger.info('Loaded %d tables: %s.', len(self), ', '.join(self.keys()))
         self._dataset_name = file_path.replace('.yaml', '').upper().split('/').pop()
-        logger.info(f'Dataset name: {self._dataset_name}.')
+        logger.info('Dataset name: %s.', self._dataset_name)
+
+        # One paginated LIST covers every table in this dataset; Table consults the set instead of calling S3.
+        prefix = f'{AWS_BUCKET_DIR}/{self.dataset_name}/'
+        paginator = s3_client.get_paginator('list_objects_v2')
+        self._existing_tables = {obj['Key'][len(prefix):].split('/')[0]
+                                 for page in paginator.paginate(Bucket=AWS_BUCKET, Prefix=prefix)
+                                 for obj in page.get('Contents', [])}
 
     @property
     def dataset_name(self) -> str:
@@ -161,20 +338,30 @@ class Dataset(dict):
         """
         return self._dataset_name
 
+    def _refresh_one(self, table_name: str, metadata: dict, as_of_date: str) -> None:
+        try:
+            table = Table(name=f'{self.dataset_name}/{table_name}',
+                          update_field=metadata['update_field'],
+                          partition_cols=metadata['partition_cols'],
+                          schema=metadata['schema'],
+                          existing_tables=self._existing_tables)
+            table.refresh(as_of_date)
+        except Exception as e:
+            logger.error('Failed to refresh %s/%s: %s', self.dataset_name, table_name, e)
+
     def update_tables(self, as_of_date: str) -> None:
         """
-        Update the S3 data for all tables defined in this object.
+        Update the S3 data for all tables defined in this object. Each table's critical path is network I/O, so
+        refreshes run concurrently; the worker count is bounded to stay clear of S3 throttling.
         """
-        for table_name, metadata in self.items():
-            try:
-                table = Table(name=f'{self.dataset_name}/{table_name}',
-                              update_field=metadata['update_field'],
-                              partition_cols=metadata['partition_cols'],
-                              schema=metadata['schema'])
-                table.refresh(as_of_date)
-            except Exception as e:
-                logger.error(f'Failed to refresh {self.dataset_name}/{table_name}: {e}')
-                continue
+        if not self:
+            logger.info('No tables defined for %s; nothing to update.', self.dataset_name)
+            return
+        with ThreadPoolExecutor(max_workers=min(MAX_REFRESH_WORKERS, len(self))) as executor:
+            futures = [executor.submit(self._refresh_one, table_name, metadata, as_of_date)
+                       for table_name, metadata in self.items()]
+            for future in as_completed(futures):
+                future.result()
 
 
 if __name__ == '__main__':
@@ -196,7 +383,6 @@ if __name__ == '__main__':
                         default=(datetime.today() - timedelta(days=1)).strftime(DATE_STRING_FORMAT),
                         help='The date to update for, in string format. Defaults to T-1.')
 
-    s3_client = boto3.client('s3')
     update_date: str = parser.parse_args().date
 
     config_file_paths = glob.glob(f"{os.path.dirname(os.path.realpath(__file__))}{SPEC_FILES_PATH}")